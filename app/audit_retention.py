@@ -0,0 +1,144 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import re
+import tempfile
+from datetime import datetime, timedelta
+from typing import List, Optional
+from sqlalchemy import text
+from app.database import engine
+from app.models import AUDIT_PARTITIONS_AHEAD, month_start, add_months, audit_partition_ddl
+
+logger = logging.getLogger(__name__)
+
+AUDIT_RETENTION_DAYS = int(os.getenv("AUDIT_RETENTION_DAYS", "90"))
+AUDIT_RETENTION_INTERVAL = int(os.getenv("AUDIT_RETENTION_INTERVAL", "3600"))
+AUDIT_ARCHIVE_DIR = os.getenv("AUDIT_ARCHIVE_DIR", "audit_archive")
+# arbitrary constant shared by every process running the retention job
+AUDIT_RETENTION_LOCK_KEY = 7207001
+PARTITION_PATTERN = re.compile(r"^audit_logs_(\d{4})(\d{2})$")
+ARCHIVE_PATTERN = re.compile(r"^audit_logs_(\d{4})(\d{2})\.jsonl\.gz$")
+
+
+async def ensure_audit_partitions():
+    current = month_start(datetime.utcnow())
+    async with engine.begin() as conn:
+        for i in range(AUDIT_PARTITIONS_AHEAD + 1):
+            await conn.execute(audit_partition_ddl(add_months(current, i)))
+
+def write_archive_rows(archive, rows):
+    archive.write("".join(json.dumps(dict(row._mapping), default=lambda value: value.isoformat()) + "\n" for row in rows).encode())
+
+def close_archive(archive, f):
+    archive.close()
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+
+def fsync_dir(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+async def archive_partition(conn, name: str, archive_dir: str):
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}.jsonl.gz")
+    # server-side cursor, the partition is never loaded into memory at once
+    # the flag name is stored with each row so archived history can be matched on more than a reused id
+    result = await conn.stream(text(
+        f"SELECT a.*, f.name AS flag_name FROM {name} a "
+        f"LEFT JOIN feature_flags f ON f.id = a.flag_id AND f.environment = a.environment "
+        f"ORDER BY a.timestamp"
+    ).execution_options(yield_per=1000))
+    # a temp file of our own, never shared with another writer
+    fd, tmp_path = tempfile.mkstemp(dir=archive_dir, prefix=f"{name}.", suffix=".tmp")
+    f = os.fdopen(fd, "wb")
+    try:
+        # compression and file io run in a thread so the event loop keeps serving requests
+        archive = gzip.GzipFile(fileobj=f, mode="wb")
+        async for rows in result.partitions():
+            await asyncio.to_thread(write_archive_rows, archive, rows)
+        await asyncio.to_thread(close_archive, archive, f)
+    except BaseException:
+        f.close()
+        os.unlink(tmp_path)
+        raise
+    # the partition is dropped right after this, so the archive must be durable first
+    os.replace(tmp_path, path)
+    await asyncio.to_thread(fsync_dir, archive_dir)
+
+async def archive_expired_partitions(retention_days: int = AUDIT_RETENTION_DAYS, archive_dir: Optional[str] = None) -> List[str]:
+    archive_dir = archive_dir or AUDIT_ARCHIVE_DIR
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    archived = []
+    async with engine.connect() as conn:
+        # every app process runs this job, only one of them may archive at a time
+        locked = await conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": AUDIT_RETENTION_LOCK_KEY})
+        if not locked.scalar():
+            logger.info("audit retention already running elsewhere, skipping")
+            return archived
+        try:
+            result = await conn.execute(text("SELECT tablename FROM pg_tables WHERE schemaname = current_schema()"))
+            for name in sorted(row.tablename for row in result):
+                match = PARTITION_PATTERN.match(name)
+                if not match:
+                    continue
+                end = add_months(datetime(int(match.group(1)), int(match.group(2)), 1), 1)
+                if end > cutoff:
+                    continue
+
+                # a partition left detached by an interrupted run is archived all the same
+                attached = await conn.execute(text("SELECT 1 FROM pg_inherits WHERE inhrelid = CAST(:name AS regclass)"), {"name": name})
+                if attached.first():
+                    await conn.execute(text(f"ALTER TABLE audit_logs DETACH PARTITION {name}"))
+                    await conn.commit()
+
+                await archive_partition(conn, name, archive_dir)
+                await conn.execute(text(f"DROP TABLE {name}"))
+                await conn.commit()
+                archived.append(name)
+                logger.info("archived audit partition %s", name)
+        finally:
+            # session level lock, it would outlive the connection in the pool
+            await conn.rollback()
+            await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": AUDIT_RETENTION_LOCK_KEY})
+            await conn.commit()
+    return archived
+
+def read_archived_logs(env: str, flag_id: int, flag_name: str, since: datetime, until: Optional[datetime] = None, archive_dir: Optional[str] = None) -> List[dict]:
+    archive_dir = archive_dir or AUDIT_ARCHIVE_DIR
+    if not os.path.isdir(archive_dir):
+        return []
+    logs = []
+    for filename in sorted(os.listdir(archive_dir)):
+        match = ARCHIVE_PATTERN.match(filename)
+        if not match:
+            continue
+        # only open the months that overlap [since, until)
+        start = datetime(int(match.group(1)), int(match.group(2)), 1)
+        if add_months(start, 1) <= since or (until is not None and start >= until):
+            continue
+        with gzip.open(os.path.join(archive_dir, filename), "rt") as f:
+            for line in f:
+                log = json.loads(line)
+                # ids restart whenever the tables are recreated, the name tells an old flag apart from a new one
+                if log["flag_id"] != flag_id or log["environment"] != env or log.get("flag_name") != flag_name:
+                    continue
+                timestamp = datetime.fromisoformat(log["timestamp"])
+                if timestamp < since or (until is not None and timestamp >= until):
+                    continue
+                logs.append(log)
+    return logs
+
+async def run_retention():
+    while True:
+        try:
+            await ensure_audit_partitions()
+            await archive_expired_partitions()
+        except Exception:
+            logger.exception("audit retention run failed")
+        await asyncio.sleep(AUDIT_RETENTION_INTERVAL)
@@ -22,9 +22,9 @@ async def dfs(node: str, visited: Set[str], rec_stack: Set[str], all_flags: dict
     
     rec_stack.remove(node)
 
-async def detect_circular_dependencies(db: AsyncSession, flag_name: str, dependencies: List[str], is_update: bool = False) -> None:
-    # Fetch all flags using ORM
-    result = await db.execute(select(FeatureFlag.name, FeatureFlag.dependencies))
+async def detect_circular_dependencies(db: AsyncSession, env: str, flag_name: str, dependencies: List[str], is_update: bool = False) -> None:
+    # Fetch the flags of this environment only, the graph never crosses environments
+    result = await db.execute(select(FeatureFlag.name, FeatureFlag.dependencies).where(FeatureFlag.environment == env))
     # print(result , result.all() , "))))))))))))))))))))))))")
     all_flags = {name: {"dependencies": dependencies} for name , dependencies in result.all()}
     # print(all_flags , "000000000000000000000")
@@ -37,27 +37,28 @@ async def detect_circular_dependencies(db: AsyncSession, flag_name: str, depende
     rec_stack = set()
     await dfs(flag_name, visited, rec_stack, all_flags)
 
-async def validate_dependencies(db: AsyncSession, flag_name: str, dependencies: List[str]) -> None:
+async def validate_dependencies(db: AsyncSession, env: str, flag_name: str, dependencies: List[str]) -> None:
     for dep in dependencies:
-        result = await db.execute(select(FeatureFlag).where(FeatureFlag.name == dep))
+        result = await db.execute(select(FeatureFlag).where(FeatureFlag.environment == env, FeatureFlag.name == dep))
         flag : FeatureFlag = result.scalars().first()
         if not flag:
             raise HTTPException(status_code=404, detail=f"Dependency {dep} not found")
         if not flag.is_enabled:
             raise HTTPException(status_code=400, detail={"error": "Missing active dependencies", "missing_dependencies": [dep]})
 
-async def cascade_disable(db: AsyncSession, flag_name: str, actor: str, reason: str):
-    # Find all flags that depend on this flag using ORM
-    result = await db.execute(select(FeatureFlag).where(FeatureFlag.dependencies.contains([flag_name])).where(FeatureFlag.is_enabled == True))
+async def cascade_disable(db: AsyncSession, env: str, flag_name: str, actor: str, reason: str):
+    # Find all flags of the same environment that depend on this flag using ORM
+    result = await db.execute(select(FeatureFlag).where(FeatureFlag.environment == env).where(FeatureFlag.dependencies.contains([flag_name])).where(FeatureFlag.is_enabled == True))
     dependent_flags = result.scalars().all()
     
     for flag in dependent_flags:
         flag.is_enabled = False
-        await redis_cache.set_flag(flag.name, {"id": flag.id, "name": flag.name, "is_enabled": False, "dependencies": flag.dependencies})
+        await redis_cache.set_flag(env, flag.name, {"id": flag.id, "environment": env, "name": flag.name, "is_enabled": False, "dependencies": flag.dependencies})
         
         # Log the cascade disable
         audit_log = AuditLog(
             flag_id=flag.id,
+            environment=env,
             action="auto-disable",
             actor=actor,
             reason=f"Cascading disable due to {flag_name} being disabled: {reason}"
@@ -65,4 +66,4 @@ async def cascade_disable(db: AsyncSession, flag_name: str, actor: str, reason:
         db.add(audit_log)
         
         # Recursively disable dependent flags
-        await cascade_disable(db, flag.name, actor, reason)
\ No newline at end of file
+        await cascade_disable(db, env, flag.name, actor, reason)
\ No newline at end of file
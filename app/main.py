@@ -1,11 +1,22 @@
 from fastapi import FastAPI, Depends, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
-from . import  database
+import asyncio
+from . import  database, audit_retention
 from app.router import flags
 
 app = FastAPI(title="Feature Flag Service")
 app.include_router(flags.router)
+app.include_router(flags.env_router)
 
 @app.on_event("startup")
 async def on_startup():
     await database.init_db()
+    app.state.retention_task = asyncio.create_task(audit_retention.run_retention())
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    app.state.retention_task.cancel()
+    try:
+        await app.state.retention_task
+    except asyncio.CancelledError:
+        pass
@@ -1,26 +1,115 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime , ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, DateTime , ForeignKeyConstraint, UniqueConstraint, Index, DDL, event
 from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy.orm import DeclarativeBase
 from datetime import datetime
 from sqlalchemy.dialects.postgresql import ARRAY
+import os
+import re
+from typing import Dict, List
+
+DEFAULT_ENVIRONMENT = os.getenv("DEFAULT_ENVIRONMENT", "default")
+# environments that get their own list partition, e.g. "dev,staging,prod-eu"
+# anything else lands in the default partition
+ENVIRONMENTS = [env.strip() for env in os.getenv("ENVIRONMENTS", "").split(",") if env.strip()]
+# 45 characters keeps feature_flags_env_<env> within the 63 byte postgres identifier limit
+ENVIRONMENT_PATTERN = r"[a-z0-9_-]{1,45}"
+POSTGRES_IDENTIFIER_LIMIT = 63
+# monthly audit partitions created in advance of the current month
+AUDIT_PARTITIONS_AHEAD = int(os.getenv("AUDIT_PARTITIONS_AHEAD", "2"))
+if AUDIT_PARTITIONS_AHEAD < 1:
+    # audit_logs has no default partition, without next month's partition
+    # inserts fail from the rollover until the retention job runs again
+    raise ValueError("AUDIT_PARTITIONS_AHEAD must be at least 1")
 
 class Base(AsyncAttrs, DeclarativeBase):
     pass
 
 class FeatureFlag(Base):
     __tablename__ = "feature_flags"
-    
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, unique=True, index=True)
+    __table_args__ = (
+        UniqueConstraint("environment", "name", name="uq_feature_flags_environment_name"),
+        # serves the dependencies @> ARRAY[...] lookups of depends_on, cascade_disable and delete_flag
+        Index("ix_feature_flags_dependencies", "dependencies", postgresql_using="gin"),
+        # the primary key leads with id, so it cannot seek to one environment in the shared default partition
+        Index("ix_feature_flags_environment_id", "environment", "id"),
+        {"postgresql_partition_by": "LIST (environment)"},
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    environment = Column(String, primary_key=True, default=DEFAULT_ENVIRONMENT)
+    name = Column(String, nullable=False)
     is_enabled = Column(Boolean, default=False)
     dependencies = Column(ARRAY(String), default=[])
 
 class AuditLog(Base):
     __tablename__ = "audit_logs"
-    
-    id = Column(Integer, primary_key=True, index=True)
-    flag_id = Column(Integer , ForeignKey("feature_flags.id"))
+    __table_args__ = (
+        ForeignKeyConstraint(["flag_id", "environment"], ["feature_flags.id", "feature_flags.environment"]),
+        Index("ix_audit_logs_environment_flag_id_timestamp", "environment", "flag_id", "timestamp"),
+        {"postgresql_partition_by": "RANGE (timestamp)"},
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    flag_id = Column(Integer)
+    environment = Column(String, default=DEFAULT_ENVIRONMENT)
     action = Column(String)
     actor = Column(String)
     reason = Column(String)
-    timestamp = Column(DateTime, default=datetime.utcnow)
\ No newline at end of file
+    timestamp = Column(DateTime, primary_key=True, default=datetime.utcnow)
+
+
+def partition_name(table: str, env: str) -> str:
+    # the env_ prefix keeps these apart from the p_default partition
+    return f"{table}_env_{re.sub(r'[^a-z0-9_]', '_', env)}"
+
+def environment_partitions(table: str, environments: List[str]) -> Dict[str, str]:
+    partitions = {}
+    for env in environments:
+        if not re.fullmatch(ENVIRONMENT_PATTERN, env):
+            raise ValueError(f"Invalid environment name: {env}")
+        name = partition_name(table, env)
+        # postgres would truncate a longer name, and two truncated names can collide silently
+        if len(name) > POSTGRES_IDENTIFIER_LIMIT:
+            raise ValueError(f"Partition name {name} for environment {env} is too long")
+        if name in partitions and partitions[name] != env:
+            raise ValueError(f"Environments {partitions[name]} and {env} map to the same partition {name}")
+        partitions[name] = env
+    return partitions
+
+def create_environment_partitions(target, connection, **kw):
+    # partitioned parent tables hold no rows themselves, so every environment
+    # needs a partition to land in before the first insert
+    for name, env in environment_partitions(target.name, ENVIRONMENTS).items():
+        connection.execute(DDL(
+            f"CREATE TABLE IF NOT EXISTS {name} "
+            f"PARTITION OF {target.name} FOR VALUES IN ('{env}')"
+        ))
+    connection.execute(DDL(
+        f"CREATE TABLE IF NOT EXISTS {target.name}_p_default PARTITION OF {target.name} DEFAULT"
+    ))
+
+event.listen(FeatureFlag.__table__, "after_create", create_environment_partitions)
+
+def month_start(dt: datetime) -> datetime:
+    return datetime(dt.year, dt.month, 1)
+
+def add_months(dt: datetime, months: int) -> datetime:
+    years, month = divmod(dt.month - 1 + months, 12)
+    return datetime(dt.year + years, month + 1, 1)
+
+def audit_partition_name(start: datetime) -> str:
+    return f"audit_logs_{start:%Y%m}"
+
+def audit_partition_ddl(start: datetime) -> DDL:
+    end = add_months(start, 1)
+    return DDL(
+        f"CREATE TABLE IF NOT EXISTS {audit_partition_name(start)} PARTITION OF audit_logs "
+        f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+    )
+
+def create_audit_partitions(target, connection, **kw):
+    current = month_start(datetime.utcnow())
+    for i in range(AUDIT_PARTITIONS_AHEAD + 1):
+        connection.execute(audit_partition_ddl(add_months(current, i)))
+
+event.listen(AuditLog.__table__, "after_create", create_audit_partitions)
@@ -7,14 +7,18 @@ class RedisCache:
     def __init__(self):
         self.client = redis.from_url(os.getenv("REDIS_URL"))
 
-    async def get_flag(self, name: str) -> Optional[dict]:
-        data = await self.client.get(f"flag:{name}")
+    @staticmethod
+    def _key(env: str, name: str) -> str:
+        return f"flag:{env}:{name}"
+
+    async def get_flag(self, env: str, name: str) -> Optional[dict]:
+        data = await self.client.get(self._key(env, name))
         return json.loads(data) if data else None
 
-    async def set_flag(self, name: str, data: dict):
-        await self.client.set(f"flag:{name}", json.dumps(data))
+    async def set_flag(self, env: str, name: str, data: dict):
+        await self.client.set(self._key(env, name), json.dumps(data))
 
-    async def delete_flag(self, name: str):
-        await self.client.delete(f"flag:{name}")
+    async def delete_flag(self, env: str, name: str):
+        await self.client.delete(self._key(env, name))
 
 redis_cache = RedisCache()
\ No newline at end of file
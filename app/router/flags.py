@@ -1,69 +1,98 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, delete
-from typing import List
+from typing import List, Literal
 from app.database import get_db
 from app.schemas import FlagCreate, FlagUpdate, FlagResponse, AuditLogResponse
-from app.models import FeatureFlag, AuditLog
+from app.models import FeatureFlag, AuditLog, DEFAULT_ENVIRONMENT, ENVIRONMENT_PATTERN
 from app.redis_client import redis_cache
 from app.dependencies import detect_circular_dependencies, validate_dependencies, cascade_disable
+from app.audit_retention import read_archived_logs
 from typing import Optional
+import asyncio
+import base64
+from datetime import datetime, timezone
+import binascii
+import re
 
+# /flags/... serves the default environment (or ?env=...), /envs/{env}/flags/... serves any environment
 router = APIRouter(prefix="/flags", tags=["flags"])
+env_router = APIRouter(prefix="/envs/{env}/flags", tags=["flags"])
+MAX_FLAG_ID = 2**31 - 1
+
+def encode_cursor(value) -> str:
+    # header values must be latin-1, flag names are arbitrary text
+    return base64.urlsafe_b64encode(str(value).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> str:
+    try:
+        return base64.b64decode(cursor.encode("ascii") + b"=" * (-len(cursor) % 4), altchars=b"-_", validate=True).decode()
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def get_environment(env: str = DEFAULT_ENVIRONMENT) -> str:
+    if not re.fullmatch(ENVIRONMENT_PATTERN, env):
+        raise HTTPException(status_code=400, detail=f"Invalid environment name: {env}")
+    return env
 
 @router.post("/", response_model=FlagResponse)
-async def create_flag(flag: FlagCreate, db: AsyncSession = Depends(get_db)):
+@env_router.post("/", response_model=FlagResponse)
+async def create_flag(flag: FlagCreate, env: str = Depends(get_environment), db: AsyncSession = Depends(get_db)):
     # Check if flag already exists or not and if flag exists raise HTTPException
-    flag_existence = select(FeatureFlag).where(FeatureFlag.name == flag.name)
+    flag_existence = select(FeatureFlag).where(FeatureFlag.environment == env, FeatureFlag.name == flag.name)
     result = await db.execute(flag_existence)
     if result.scalars().first():
         raise HTTPException(status_code=400, detail="Flag already exists")
     
     # Validate dependencies exist in database and if not raise HTTPException
     for dep in flag.dependencies:
-        result = await db.execute(select(FeatureFlag).where(FeatureFlag.name == dep))
+        result = await db.execute(select(FeatureFlag).where(FeatureFlag.environment == env, FeatureFlag.name == dep))
         if not result.scalars().first():
             raise HTTPException(status_code=404, detail=f"Dependency {dep} not found")
     
     # Check for circular dependencies
-    await detect_circular_dependencies(db, flag.name, flag.dependencies)
+    await detect_circular_dependencies(db, env, flag.name, flag.dependencies)
     
     # Create new flag
-    new_flag : FeatureFlag = FeatureFlag(name=flag.name, dependencies=flag.dependencies)
+    new_flag : FeatureFlag = FeatureFlag(environment=env, name=flag.name, dependencies=flag.dependencies)
     db.add(new_flag)
     await db.commit()
     await db.refresh(new_flag)
     
     # Cache the flag
-    await redis_cache.set_flag(flag.name, {
+    await redis_cache.set_flag(env, flag.name, {
         "id": new_flag.id,
+        "environment": new_flag.environment,
         "name": new_flag.name,
         "is_enabled": new_flag.is_enabled,
         "dependencies": new_flag.dependencies
     })
     
     # Log creation
-    audit_log = AuditLog(flag_id=new_flag.id, action="create", actor=flag.actor, reason=flag.reason)
+    audit_log = AuditLog(flag_id=new_flag.id, environment=env, action="create", actor=flag.actor, reason=flag.reason)
     db.add(audit_log)
     await db.commit()
     
     return FlagResponse(**new_flag.__dict__)
 
 @router.get("/{flag_name}", response_model=FlagResponse)
-async def get_flag(flag_name: str, db: AsyncSession = Depends(get_db)):
+@env_router.get("/{flag_name}", response_model=FlagResponse)
+async def get_flag(flag_name: str, env: str = Depends(get_environment), db: AsyncSession = Depends(get_db)):
     # Check cache first
-    cached_flag = await redis_cache.get_flag(flag_name)
+    cached_flag = await redis_cache.get_flag(env, flag_name)
     if cached_flag:
         return FlagResponse(**cached_flag)
 
-    result = await db.execute(select(FeatureFlag).where(FeatureFlag.name == flag_name))
+    result = await db.execute(select(FeatureFlag).where(FeatureFlag.environment == env, FeatureFlag.name == flag_name))
     flag = result.scalars().first()
     if not flag:
         raise HTTPException(status_code=404, detail="Flag not found")
     
     # Update cache
-    await redis_cache.set_flag(flag_name, {
+    await redis_cache.set_flag(env, flag_name, {
         "id": flag.id,
+        "environment": flag.environment,
         "name": flag.name,
         "is_enabled": flag.is_enabled,
         "dependencies": flag.dependencies
@@ -71,29 +100,75 @@ async def get_flag(flag_name: str, db: AsyncSession = Depends(get_db)):
     
     return FlagResponse(**flag.__dict__)
 
+def build_flags_query(env: str, order_by: str, after: Optional[str], enabled: Optional[bool], prefix: Optional[str], depends_on: Optional[str]):
+    # keyset pagination: seek past the cursor on an indexed column instead of OFFSET
+    sort_column = FeatureFlag.id if order_by == "id" else FeatureFlag.name
+    stmt = select(FeatureFlag.id, FeatureFlag.environment, FeatureFlag.name, FeatureFlag.is_enabled, FeatureFlag.dependencies)
+    stmt = stmt.where(FeatureFlag.environment == env).order_by(sort_column)
+    if after is not None:
+        after = decode_cursor(after)
+        if order_by == "id":
+            # ids are int4, anything larger would fail in the driver instead of here
+            if not after.isdecimal() or not after.isascii() or int(after) > MAX_FLAG_ID:
+                raise HTTPException(status_code=400, detail="Cursor must be a valid flag id when ordering by id")
+            after = int(after)
+        stmt = stmt.where(sort_column > after)
+    if enabled is not None:
+        stmt = stmt.where(FeatureFlag.is_enabled == enabled)
+    if prefix:
+        stmt = stmt.where(FeatureFlag.name.startswith(prefix, autoescape=True))
+    if depends_on:
+        stmt = stmt.where(FeatureFlag.dependencies.contains([depends_on]))
+    return stmt
+
 @router.get("/", response_model=List[FlagResponse])
-async def get_flags(db: AsyncSession = Depends(get_db)):
+@env_router.get("/", response_model=List[FlagResponse])
+async def get_flags(
+    response: Response,
+    limit: int = Query(100, ge=1, le=1000),
+    after: Optional[str] = None,
+    order_by: Literal["id", "name"] = "id",
+    enabled: Optional[bool] = None,
+    prefix: Optional[str] = None,
+    depends_on: Optional[str] = None,
+    stream: bool = False,
+    env: str = Depends(get_environment),
+    db: AsyncSession = Depends(get_db),
+):
+    stmt = build_flags_query(env, order_by, after, enabled, prefix, depends_on)
 
-    result = await db.execute(select(FeatureFlag))
-    flags = result.scalars().all()
-    if not flags:
-        raise HTTPException(status_code=404, detail="cant find any flags")
-    
-    return [FlagResponse(**flag.__dict__) for flag in flags]
+    if stream:
+        # NDJSON over a server-side cursor, rows are fetched in batches and never held all at once
+        async def generate():
+            result = await db.stream(stmt.execution_options(yield_per=500))
+            async for row in result:
+                yield FlagResponse(**row._mapping).model_dump_json() + "\n"
+        return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+    # fetch one extra row to know whether there is a next page
+    result = await db.execute(stmt.limit(limit + 1))
+    rows = result.all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(last.id if order_by == "id" else last.name)
+
+    return [FlagResponse(**row._mapping) for row in rows]
 
 
 
 @router.put("/{flag_name}", response_model=FlagResponse)
-async def update_flag(flag_name: str, flag_update: FlagUpdate, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(FeatureFlag).where(FeatureFlag.name == flag_name))
+@env_router.put("/{flag_name}", response_model=FlagResponse)
+async def update_flag(flag_name: str, flag_update: FlagUpdate, env: str = Depends(get_environment), db: AsyncSession = Depends(get_db)):
+    result = await db.execute(select(FeatureFlag).where(FeatureFlag.environment == env, FeatureFlag.name == flag_name))
     flag = result.scalars().first()
     if not flag:
         raise HTTPException(status_code=404, detail="Flag not found")
     
     if flag_update.dependencies is not None:
-        await detect_circular_dependencies(db, flag_name, flag_update.dependencies, is_update=True)
+        await detect_circular_dependencies(db, env, flag_name, flag_update.dependencies, is_update=True)
         for dep in flag_update.dependencies:
-            result = await db.execute(select(FeatureFlag).where(FeatureFlag.name == dep))
+            result = await db.execute(select(FeatureFlag).where(FeatureFlag.environment == env, FeatureFlag.name == dep))
             if not result.scalars().first():
                 raise HTTPException(status_code=404, detail=f"Dependency {dep} not found")
         flag.dependencies = flag_update.dependencies
@@ -101,18 +176,19 @@ async def update_flag(flag_name: str, flag_update: FlagUpdate, db: AsyncSession
     # If enabling flag
     if flag_update.is_enabled is not None:
         if flag_update.is_enabled:
-            await validate_dependencies(db, flag_name, flag.dependencies)
+            await validate_dependencies(db, env, flag_name, flag.dependencies)
         else:
             # Handle cascade disable for dependent flags
-            await cascade_disable(db, flag_name, flag_update.actor, flag_update.reason or "Flag disabled")
+            await cascade_disable(db, env, flag_name, flag_update.actor, flag_update.reason or "Flag disabled")
         flag.is_enabled = flag_update.is_enabled
     
     await db.commit()
     await db.refresh(flag)
     
     # Update cache
-    await redis_cache.set_flag(flag_name, {
+    await redis_cache.set_flag(env, flag_name, {
         "id": flag.id,
+        "environment": flag.environment,
         "name": flag.name,
         "is_enabled": flag.is_enabled,
         "dependencies": flag.dependencies
@@ -121,6 +197,7 @@ async def update_flag(flag_name: str, flag_update: FlagUpdate, db: AsyncSession
     # Log update
     audit_log = AuditLog(
         flag_id=flag.id,
+        environment=env,
         action="update",
         actor=flag_update.actor,
         reason=flag_update.reason
@@ -131,23 +208,25 @@ async def update_flag(flag_name: str, flag_update: FlagUpdate, db: AsyncSession
     return FlagResponse(**flag.__dict__)
 
 @router.delete("/{flag_name}")
-async def delete_flag(flag_name: str, actor: str, reason: Optional[str] = None, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(FeatureFlag).where(FeatureFlag.name == flag_name))
+@env_router.delete("/{flag_name}")
+async def delete_flag(flag_name: str, actor: str, reason: Optional[str] = None, env: str = Depends(get_environment), db: AsyncSession = Depends(get_db)):
+    result = await db.execute(select(FeatureFlag).where(FeatureFlag.environment == env, FeatureFlag.name == flag_name))
     flag = result.scalars().first()
     if not flag:
         raise HTTPException(status_code=404, detail="Flag not found")
     
     # Check if flag is a dependency for other flags
-    result = await db.execute(select(FeatureFlag).where(FeatureFlag.dependencies.contains([flag_name])))
+    result = await db.execute(select(FeatureFlag).where(FeatureFlag.environment == env, FeatureFlag.dependencies.contains([flag_name])))
     if result.scalars().first():
         raise HTTPException(status_code=400, detail="Cannot delete flag with dependent flags")
     
     # Clear cache
-    await redis_cache.delete_flag(flag_name)
+    await redis_cache.delete_flag(env, flag_name)
     
     # Log deletion
     audit_log = AuditLog(
         flag_id=flag.id,
+        environment=env,
         action="delete",
         actor=actor,
         reason=reason
@@ -158,14 +237,33 @@ async def delete_flag(flag_name: str, actor: str, reason: Optional[str] = None,
     return {"message": f"Flag <{flag_name}> deleted successfully"}
 
 @router.get("/{flag_name}/audit", response_model=List[AuditLogResponse])
-async def get_audit_logs(flag_name: str, db: AsyncSession = Depends(get_db)):
-    stmt = select(FeatureFlag).where(FeatureFlag.name == flag_name)
+@env_router.get("/{flag_name}/audit", response_model=List[AuditLogResponse])
+async def get_audit_logs(flag_name: str, include_archived: bool = False, since: Optional[datetime] = None, until: Optional[datetime] = None, env: str = Depends(get_environment), db: AsyncSession = Depends(get_db)):
+    stmt = select(FeatureFlag).where(FeatureFlag.environment == env, FeatureFlag.name == flag_name)
     result = await db.execute(stmt)
     flag = result.scalars().first()
     if not flag:
         raise HTTPException(status_code=404, detail="Flag not found")
     
-    stmt = select(AuditLog).where(AuditLog.flag_id == flag.id)
+    # timestamps are stored as naive utc
+    if since is not None and since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    if until is not None and until.tzinfo is not None:
+        until = until.astimezone(timezone.utc).replace(tzinfo=None)
+    
+    # Archived partitions are older than anything still in the table, so they go first
+    archived_logs = []
+    if include_archived:
+        # without a lower bound every archive ever written would be decompressed
+        if since is None:
+            raise HTTPException(status_code=400, detail="since is required with include_archived")
+        archived_logs = await asyncio.to_thread(read_archived_logs, env, flag.id, flag_name, since, until)
+    
+    stmt = select(AuditLog).where(AuditLog.environment == env, AuditLog.flag_id == flag.id).order_by(AuditLog.timestamp)
+    if since is not None:
+        stmt = stmt.where(AuditLog.timestamp >= since)
+    if until is not None:
+        stmt = stmt.where(AuditLog.timestamp < until)
     result = await db.execute(stmt)
     logs = result.scalars().all()
-    return [AuditLogResponse(flag_name=flag_name, **log.__dict__) for log in logs]
\ No newline at end of file
+    return [AuditLogResponse(**log) for log in archived_logs] + [AuditLogResponse(flag_name=flag_name, **log.__dict__) for log in logs]
\ No newline at end of file
@@ -19,12 +19,14 @@ class FlagUpdate(BaseModel):
 
 class FlagResponse(BaseModel):
     id: int
+    environment: str
     name: str
     is_enabled: bool
     dependencies: List[str]
 
 class AuditLogResponse(BaseModel):
     id: int
+    environment: str
     flag_name: str
     action: str
     actor: str
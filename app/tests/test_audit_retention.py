@@ -0,0 +1,114 @@
+import gzip
+import json
+import pytest
+from datetime import datetime
+from sqlalchemy import text
+from app import audit_retention
+from app.database import engine
+from app.models import AuditLog, add_months, audit_partition_ddl, audit_partition_name
+from app.audit_retention import read_archived_logs, archive_expired_partitions, ensure_audit_partitions
+
+def test_add_months_crosses_year():
+    assert add_months(datetime(2025, 11, 15), 2) == datetime(2026, 1, 1)
+
+def test_audit_partition_name():
+    assert audit_partition_name(datetime(2026, 1, 1)) == "audit_logs_202601"
+
+def test_read_archived_logs(tmp_path):
+    rows = [
+        {"id": 1, "flag_id": 7, "flag_name": "checkout", "environment": "staging", "action": "create", "actor": "a", "reason": None, "timestamp": "2025-01-02T10:00:00"},
+        {"id": 2, "flag_id": 7, "flag_name": "checkout", "environment": "prod", "action": "create", "actor": "a", "reason": None, "timestamp": "2025-01-02T10:00:00"},
+        {"id": 3, "flag_id": 8, "flag_name": "search", "environment": "staging", "action": "create", "actor": "a", "reason": None, "timestamp": "2025-01-03T10:00:00"},
+        # same id as checkout, written before the tables were recreated
+        {"id": 4, "flag_id": 7, "flag_name": "old-flag", "environment": "staging", "action": "create", "actor": "a", "reason": None, "timestamp": "2025-01-04T10:00:00"},
+        {"id": 5, "flag_id": 7, "flag_name": "checkout", "environment": "staging", "action": "update", "actor": "a", "reason": None, "timestamp": "2025-01-20T10:00:00"},
+    ]
+    with gzip.open(tmp_path / "audit_logs_202501.jsonl.gz", "wt") as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+    logs = read_archived_logs("staging", 7, "checkout", since=datetime(2025, 1, 1), archive_dir=str(tmp_path))
+    assert [log["id"] for log in logs] == [1, 5]
+    logs = read_archived_logs("staging", 7, "checkout", since=datetime(2025, 1, 1), until=datetime(2025, 1, 10), archive_dir=str(tmp_path))
+    assert [log["id"] for log in logs] == [1]
+
+def test_read_archived_logs_skips_months_out_of_range(tmp_path):
+    # not a gzip file, opening it would raise
+    (tmp_path / "audit_logs_202401.jsonl.gz").write_bytes(b"corrupt")
+    assert read_archived_logs("staging", 7, "checkout", since=datetime(2025, 1, 1), archive_dir=str(tmp_path)) == []
+    assert read_archived_logs("staging", 7, "checkout", since=datetime(2023, 1, 1), until=datetime(2024, 1, 1), archive_dir=str(tmp_path)) == []
+
+def test_read_archived_logs_without_archive(tmp_path):
+    assert read_archived_logs("staging", 7, "checkout", since=datetime(2025, 1, 1), archive_dir=str(tmp_path / "missing")) == []
+
+async def create_old_audit_row(client, db, flag_name: str, month: datetime) -> dict:
+    response = await client.post("/envs/archive/flags/", json={"name": flag_name, "actor": "test_user"})
+    flag_id = response.json()["id"]
+    async with engine.begin() as conn:
+        await conn.execute(audit_partition_ddl(month))
+    db.add(AuditLog(flag_id=flag_id, environment="archive", action="update", actor="old_actor", reason="old", timestamp=month.replace(day=15)))
+    await db.commit()
+    return {"flag_id": flag_id, "actor": "old_actor"}
+
+async def table_exists(name: str) -> bool:
+    async with engine.connect() as conn:
+        result = await conn.execute(text("SELECT 1 FROM pg_tables WHERE tablename = :name"), {"name": name})
+        return result.first() is not None
+
+@pytest.mark.asyncio
+async def test_archive_expired_partitions(client, db, tmp_path, monkeypatch):
+    monkeypatch.setattr(audit_retention, "AUDIT_ARCHIVE_DIR", str(tmp_path))
+    expected = await create_old_audit_row(client, db, "archived_flag", datetime(2000, 1, 1))
+
+    archived = await archive_expired_partitions(archive_dir=str(tmp_path))
+
+    assert "audit_logs_200001" in archived
+    assert not await table_exists("audit_logs_200001")
+    with gzip.open(tmp_path / "audit_logs_200001.jsonl.gz", "rt") as f:
+        rows = [json.loads(line) for line in f]
+    assert [(row["flag_id"], row["flag_name"], row["actor"]) for row in rows] == [(expected["flag_id"], "archived_flag", expected["actor"])]
+
+    response = await client.get("/envs/archive/flags/archived_flag/audit?include_archived=true&since=2000-01-01T00:00:00")
+    assert response.status_code == 200
+    assert response.json()[0]["actor"] == "old_actor"
+    assert response.json()[0]["timestamp"].startswith("2000-01-15")
+    response = await client.get("/envs/archive/flags/archived_flag/audit?include_archived=true")
+    assert response.status_code == 400
+    response = await client.get("/envs/archive/flags/archived_flag/audit")
+    assert all(log["actor"] != "old_actor" for log in response.json())
+
+@pytest.mark.asyncio
+async def test_archive_resumes_detached_partition(client, db, tmp_path):
+    expected = await create_old_audit_row(client, db, "detached_flag", datetime(2000, 2, 1))
+    # a previous run detached the partition and stopped before archiving it
+    async with engine.begin() as conn:
+        await conn.execute(text("ALTER TABLE audit_logs DETACH PARTITION audit_logs_200002"))
+
+    archived = await archive_expired_partitions(archive_dir=str(tmp_path))
+
+    assert "audit_logs_200002" in archived
+    assert not await table_exists("audit_logs_200002")
+    logs = read_archived_logs("archive", expected["flag_id"], "detached_flag", since=datetime(2000, 1, 1), archive_dir=str(tmp_path))
+    assert [log["actor"] for log in logs] == ["old_actor"]
+
+@pytest.mark.asyncio
+async def test_ensure_audit_partitions(client):
+    async with engine.begin() as conn:
+        await conn.execute(text("DROP TABLE IF EXISTS " + audit_partition_name(add_months(datetime.utcnow(), 1))))
+    await ensure_audit_partitions()
+    assert await table_exists(audit_partition_name(add_months(datetime.utcnow(), 1)))
+
+@pytest.mark.asyncio
+async def test_archive_skips_while_another_run_holds_the_lock(client, db, tmp_path):
+    await create_old_audit_row(client, db, "locked_flag", datetime(2000, 3, 1))
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": audit_retention.AUDIT_RETENTION_LOCK_KEY})
+        try:
+            assert await archive_expired_partitions(archive_dir=str(tmp_path)) == []
+            assert await table_exists("audit_logs_200003")
+        finally:
+            await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": audit_retention.AUDIT_RETENTION_LOCK_KEY})
+            await conn.commit()
+    assert "audit_logs_200003" in await archive_expired_partitions(archive_dir=str(tmp_path))
+    names = [path.name for path in tmp_path.iterdir()]
+    assert "audit_logs_200003.jsonl.gz" in names
+    assert not any(name.endswith(".tmp") for name in names)
@@ -1,5 +1,10 @@
+import json
 import pytest
-from app.models import FeatureFlag
+from sqlalchemy import text
+from app import models
+from app.database import engine
+from app.models import FeatureFlag, environment_partitions
+from app.router.flags import encode_cursor, decode_cursor
 
 @pytest.mark.asyncio
 async def test_create_flag(client, db):
@@ -69,4 +74,125 @@ async def test_delete_flag_with_dependents(client):
     await client.post("/flags/", json={"name": "test_flag", "dependencies": ["dep_flag"], "actor": "test_user"})
     response = await client.delete("/flags/dep_flag?actor=test_user")
     assert response.status_code == 400
-    assert "Cannot delete flag with dependent flags" in response.json()["detail"]
\ No newline at end of file
+    assert "Cannot delete flag with dependent flags" in response.json()["detail"]
+
+@pytest.mark.asyncio
+async def test_same_flag_name_in_two_environments(client):
+    response = await client.post("/envs/staging/flags/", json={"name": "env_flag", "actor": "test_user"})
+    assert response.status_code == 200
+    assert response.json()["environment"] == "staging"
+    response = await client.post("/envs/prod-eu/flags/", json={"name": "env_flag", "actor": "test_user"})
+    assert response.status_code == 200
+    await client.put("/envs/staging/flags/env_flag", json={"is_enabled": True, "actor": "test_user"})
+    response = await client.get("/envs/prod-eu/flags/env_flag")
+    assert response.json()["is_enabled"] is False
+
+@pytest.mark.asyncio
+async def test_dependency_graph_is_per_environment(client):
+    await client.post("/envs/staging/flags/", json={"name": "graph_a", "actor": "test_user"})
+    await client.post("/envs/staging/flags/", json={"name": "graph_b", "dependencies": ["graph_a"], "actor": "test_user"})
+    # graph_a only exists in staging, so prod-eu cannot depend on it
+    response = await client.post("/envs/prod-eu/flags/", json={"name": "graph_b", "dependencies": ["graph_a"], "actor": "test_user"})
+    assert response.status_code == 404
+    await client.post("/envs/prod-eu/flags/", json={"name": "graph_a", "actor": "test_user"})
+    await client.post("/envs/prod-eu/flags/", json={"name": "graph_b", "actor": "test_user"})
+    # the staging edge graph_b -> graph_a does not make this a cycle in prod-eu
+    response = await client.put("/envs/prod-eu/flags/graph_a", json={"dependencies": ["graph_b"], "actor": "test_user"})
+    assert response.status_code == 200
+
+@pytest.mark.asyncio
+async def test_list_flags_empty_environment(client):
+    response = await client.get("/envs/empty-env/flags/")
+    assert response.status_code == 200
+    assert response.json() == []
+
+@pytest.mark.asyncio
+async def test_list_flags_keyset_pagination(client):
+    for i in range(5):
+        await client.post("/envs/paging/flags/", json={"name": f"page_{i}", "actor": "test_user"})
+    response = await client.get("/envs/paging/flags/?order_by=name&limit=2")
+    assert [flag["name"] for flag in response.json()] == ["page_0", "page_1"]
+    cursor = response.headers["X-Next-Cursor"]
+    response = await client.get(f"/envs/paging/flags/?order_by=name&limit=2&after={cursor}")
+    assert [flag["name"] for flag in response.json()] == ["page_2", "page_3"]
+    response = await client.get(f"/envs/paging/flags/?order_by=name&limit=2&after={response.headers['X-Next-Cursor']}")
+    assert [flag["name"] for flag in response.json()] == ["page_4"]
+    assert "X-Next-Cursor" not in response.headers
+
+@pytest.mark.asyncio
+async def test_list_flags_filters_and_stream(client):
+    await client.post("/envs/filters/flags/", json={"name": "base", "actor": "test_user"})
+    await client.post("/envs/filters/flags/", json={"name": "child", "dependencies": ["base"], "actor": "test_user"})
+    await client.put("/envs/filters/flags/base", json={"is_enabled": True, "actor": "test_user"})
+    response = await client.get("/envs/filters/flags/?depends_on=base")
+    assert [flag["name"] for flag in response.json()] == ["child"]
+    response = await client.get("/envs/filters/flags/?enabled=true")
+    assert [flag["name"] for flag in response.json()] == ["base"]
+    response = await client.get("/envs/filters/flags/?prefix=ch&stream=true")
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [flag["name"] for flag in lines] == ["child"]
+
+def test_environment_partition_names():
+    partitions = environment_partitions("feature_flags", ["default", "staging"])
+    assert partitions == {"feature_flags_env_default": "default", "feature_flags_env_staging": "staging"}
+    with pytest.raises(ValueError):
+        environment_partitions("feature_flags", ["prod-eu", "prod_eu"])
+    # the longest allowed name still fits in a postgres identifier
+    assert len(next(iter(environment_partitions("feature_flags", ["a" * 45])))) <= 63
+    with pytest.raises(ValueError):
+        environment_partitions("feature_flags", ["a" * 46])
+    with pytest.raises(ValueError):
+        environment_partitions("feature_flags", ["dev\n"])
+    with pytest.raises(ValueError):
+        environment_partitions("a_much_longer_table_name", ["a" * 45])
+
+@pytest.mark.asyncio
+async def test_invalid_environment_names_rejected(client):
+    response = await client.get("/envs/dev%0A/flags/")
+    assert response.status_code == 400
+    response = await client.get(f"/envs/{'a' * 46}/flags/")
+    assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_listed_environment_gets_own_partition(client, monkeypatch):
+    monkeypatch.setattr(models, "ENVIRONMENTS", ["listed-env", "default"])
+    async with engine.begin() as conn:
+        await conn.run_sync(lambda sync_conn: models.create_environment_partitions(FeatureFlag.__table__, sync_conn))
+    response = await client.post("/envs/listed-env/flags/", json={"name": "listed_flag", "actor": "test_user"})
+    assert response.status_code == 200
+    # environments that are not listed still land in the default partition
+    response = await client.post("/envs/unlisted-env/flags/", json={"name": "unlisted_flag", "actor": "test_user"})
+    assert response.status_code == 200
+    async with engine.connect() as conn:
+        result = await conn.execute(text("SELECT name, tableoid::regclass::text AS partition FROM feature_flags WHERE name IN ('listed_flag', 'unlisted_flag')"))
+        partitions = {row.name: row.partition for row in result}
+    assert partitions == {"listed_flag": "feature_flags_env_listed_env", "unlisted_flag": "feature_flags_p_default"}
+
+@pytest.mark.asyncio
+async def test_list_flags_rejects_out_of_range_cursor(client):
+    response = await client.get(f"/envs/paging/flags/?after={encode_cursor(99999999999)}")
+    assert response.status_code == 400
+    response = await client.get(f"/envs/paging/flags/?after={encode_cursor('abc')}")
+    assert response.status_code == 400
+    # superscript two passes str.isdigit() but int() rejects it
+    response = await client.get(f"/envs/paging/flags/?after={encode_cursor('²')}")
+    assert response.status_code == 400
+    response = await client.get("/envs/paging/flags/?after=%C2%B2")
+    assert response.status_code == 400
+    response = await client.get("/envs/paging/flags/?after=not*base64")
+    assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_list_flags_cursor_with_non_ascii_name(client):
+    for name in ["flag-日本", "flag-ü", "flag-z"]:
+        await client.post("/envs/unicode/flags/", json={"name": name, "actor": "test_user"})
+    response = await client.get("/envs/unicode/flags/?order_by=name&limit=1")
+    assert response.status_code == 200
+    seen = [flag["name"] for flag in response.json()]
+    while "X-Next-Cursor" in response.headers:
+        response = await client.get(f"/envs/unicode/flags/?order_by=name&limit=1&after={response.headers['X-Next-Cursor']}")
+        assert response.status_code == 200
+        seen += [flag["name"] for flag in response.json()]
+    assert sorted(seen) == sorted(["flag-日本", "flag-ü", "flag-z"])
+    assert decode_cursor(encode_cursor("flag-日本")) == "flag-日本"